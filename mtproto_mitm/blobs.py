@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import json
+import os
+from hashlib import sha256
+from pathlib import Path
+from threading import get_ident
+from typing import Any
+
+BLOB_KEY = "_blob"
+
+
+class BlobStore:
+    def __init__(self, directory: Path, threshold: int = 4096):
+        self.directory = directory
+        self.threshold = threshold
+        self._known: set[str] = set()
+
+    def _path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest
+
+    def put(self, data: bytes) -> str:
+        digest = sha256(data).hexdigest()
+        if digest in self._known:
+            return digest
+
+        path = self._path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{digest}.{get_ident()}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        self._known.add(digest)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with open(self._path(digest), "rb") as f:
+            return f.read()
+
+    def resolve(self, obj: dict) -> Any:
+        if len(obj) == 1 and BLOB_KEY in obj:
+            return self.get(obj[BLOB_KEY]).hex()
+        return obj
+
+
+def load_recording(path: Path, blobs: BlobStore | None = None) -> list[dict]:
+    if blobs is None and (path.parent / "blobs").is_dir():
+        blobs = BlobStore(path.parent / "blobs")
+
+    object_hook = blobs.resolve if blobs is not None else None
+    with open(path) as f:
+        if path.suffix == ".jsonl":
+            return [json.loads(line, object_hook=object_hook) for line in f if line.strip()]
+        return json.load(f, object_hook=object_hook)
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import sys
+from collections import OrderedDict
+from threading import Lock
+from typing import Generic, Hashable, TypeVar, BinaryIO
+
+from mtproto_mitm.tl import TLObject
+
+T = TypeVar("T")
+
+
+class LRU(Generic[T]):
+    __slots__ = ("_entries", "_max_entries", "_lock",)
+
+    def __init__(self, max_entries: int):
+        self._entries: OrderedDict[Hashable, T] = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> T | None:
+        with self._lock:
+            if (value := self._entries.get(key)) is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: T) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+class CacheStats:
+    __slots__ = ("hits", "misses", "interned_objects", "interned_strings",)
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.interned_objects = 0
+        self.interned_strings = 0
+
+    def __repr__(self) -> str:
+        total = self.hits + self.misses
+        return (
+            f"hits={self.hits}/{total} ({self.hits / total if total else 0:.0%}), "
+            f"interned objects={self.interned_objects}, interned strings={self.interned_strings}"
+        )
+
+
+class DecodeCache:
+    def __init__(self, max_entries: int = 4096, max_size: int = 1024):
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._payloads: LRU[TLObject] = LRU(max_entries)
+        self._objects: LRU[TLObject] = LRU(max_entries)
+
+    # Objects returned from cache are shared between messages, so they must not be modified
+
+    def get(self, data: bytes) -> TLObject | None:
+        if len(data) > self.max_size:
+            return None
+
+        if (obj := self._payloads.get(data)) is not None:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+        return obj
+
+    def put(self, data: bytes, obj: TLObject) -> None:
+        if len(data) <= self.max_size:
+            self._payloads.put(data, obj)
+
+    def intern_object(self, stream: BinaryIO, start: int, obj: TLObject) -> TLObject:
+        end = stream.tell()
+        if end - start > self.max_size:
+            return obj
+
+        stream.seek(start)
+        key = stream.read(end - start)
+        if (interned := self._objects.get(key)) is not None:
+            self.stats.interned_objects += 1
+            return interned
+
+        self._objects.put(key, obj)
+        return obj
+
+    def intern_string(self, value: str) -> str:
+        if len(value) > self.max_size:
+            return value
+
+        if (interned := sys.intern(value)) is not value:
+            self.stats.interned_strings += 1
+        return interned
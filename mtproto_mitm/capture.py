@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import struct
+import zlib
+from bisect import bisect_right
+from concurrent.futures import Executor, ThreadPoolExecutor
+from enum import IntEnum
+from pathlib import Path
+from time import time
+from typing import Iterator, NamedTuple, BinaryIO
+
+from socks5server import DataDirection
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"MTMC"
+INDEX_MAGIC = b"MTMI"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sBBH")
+_BLOCK_HEADER = struct.Struct("<IIId")
+_RECORD_HEADER = struct.Struct("<dBI")
+_INDEX_ENTRY = struct.Struct("<QdQI")
+_FOOTER = struct.Struct("<QI4s")
+
+_DIRECTIONS = {DataDirection.CLIENT_TO_DST: 0, DataDirection.DST_TO_CLIENT: 1}
+_DIRECTIONS_REV = {value: key for key, value in _DIRECTIONS.items()}
+
+
+class Codec(IntEnum):
+    NONE = 0
+    ZLIB = 1
+    ZSTD = 2
+
+    @classmethod
+    def best_available(cls) -> Codec:
+        return cls.ZSTD if zstandard is not None else cls.ZLIB
+
+    def compressor(self):
+        if self is Codec.ZSTD:
+            return zstandard.ZstdCompressor(level=3).compress
+        elif self is Codec.ZLIB:
+            return lambda data: zlib.compress(data, 6)
+        return bytes
+
+    def decompressor(self):
+        if self is Codec.ZSTD:
+            if zstandard is None:
+                raise RuntimeError("Capture is compressed with zstd, but zstandard is not installed")
+            return zstandard.ZstdDecompressor().decompress
+        elif self is Codec.ZLIB:
+            return zlib.decompress
+        return bytes
+
+
+class CaptureRecord(NamedTuple):
+    timestamp: float
+    direction: DataDirection
+    data: bytes
+
+
+class BlockInfo(NamedTuple):
+    offset: int
+    first_timestamp: float
+    first_record: int
+    records: int
+
+
+class CaptureWriter:
+    def __init__(
+            self, path: Path, executor: Executor | None = None, block_size: int = 256 * 1024,
+            codec: Codec | None = None,
+    ):
+        self._path = path
+        self._own_executor = executor is None
+        self._executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+        self._block_size = block_size
+        self._codec = codec if codec is not None else Codec.best_available()
+        self._compress = self._codec.compressor()
+
+        self._block: list[bytes] = []
+        self._block_bytes = 0
+        self._block_records = 0
+        self._block_timestamp = 0.0
+        self._records = 0
+
+        self._file: BinaryIO | None = None
+        self._index: list[BlockInfo] = []
+
+        self._executor.submit(self._open)
+
+    def write(self, direction: DataDirection, data: bytes, timestamp: float | None = None) -> None:
+        if timestamp is None:
+            timestamp = time()
+        if not self._block_records:
+            self._block_timestamp = timestamp
+
+        self._block.append(_RECORD_HEADER.pack(timestamp, _DIRECTIONS[direction], len(data)))
+        self._block.append(data)
+        self._block_bytes += _RECORD_HEADER.size + len(data)
+        self._block_records += 1
+
+        if self._block_bytes >= self._block_size:
+            self._flush_block()
+
+    def _flush_block(self) -> None:
+        if not self._block_records:
+            return
+
+        block = BlockInfo(0, self._block_timestamp, self._records, self._block_records)
+        self._executor.submit(self._write_block, self._block, block)
+
+        self._records += self._block_records
+        self._block = []
+        self._block_bytes = 0
+        self._block_records = 0
+
+    def close(self) -> None:
+        self._flush_block()
+        self._executor.submit(self._finish)
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    # Methods below are executed on the writer thread
+
+    def _open(self) -> None:
+        self._file = open(self._path, "wb")
+        self._file.write(_HEADER.pack(MAGIC, VERSION, self._codec, 0))
+
+    def _write_block(self, parts: list[bytes], block: BlockInfo) -> None:
+        raw = b"".join(parts)
+        compressed = self._compress(raw)
+
+        self._index.append(block._replace(offset=self._file.tell()))
+        self._file.write(_BLOCK_HEADER.pack(len(compressed), len(raw), block.records, block.first_timestamp))
+        self._file.write(compressed)
+
+    def _finish(self) -> None:
+        index_offset = self._file.tell()
+        for block in self._index:
+            self._file.write(_INDEX_ENTRY.pack(*block))
+        self._file.write(_FOOTER.pack(index_offset, len(self._index), INDEX_MAGIC))
+        self._file.close()
+
+
+class CaptureReader:
+    def __init__(self, path: Path):
+        self._file = open(path, "rb")
+
+        magic, version, codec, _ = _HEADER.unpack(self._file.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        if version != VERSION:
+            raise ValueError(f"Unsupported capture file version: {version}")
+
+        self._decompress = Codec(codec).decompressor()
+        self.blocks = self._read_index() or self._scan_blocks()
+        self._timestamps = [block.first_timestamp for block in self.blocks]
+        self._first_records = [block.first_record for block in self.blocks]
+
+    def _read_index(self) -> list[BlockInfo] | None:
+        size = self._file.seek(0, 2)
+        if size < _HEADER.size + _FOOTER.size:
+            return None
+
+        self._file.seek(size - _FOOTER.size)
+        index_offset, count, magic = _FOOTER.unpack(self._file.read(_FOOTER.size))
+        if magic != INDEX_MAGIC or index_offset + count * _INDEX_ENTRY.size + _FOOTER.size != size:
+            return None
+
+        self._file.seek(index_offset)
+        data = self._file.read(count * _INDEX_ENTRY.size)
+        return [BlockInfo(*entry) for entry in _INDEX_ENTRY.iter_unpack(data)]
+
+    def _scan_blocks(self) -> list[BlockInfo]:
+        # Capture was not closed properly (e.g. proxy was killed), so there is no index: walk block headers instead
+        blocks = []
+        records = 0
+        offset = _HEADER.size
+        while True:
+            self._file.seek(offset)
+            header = self._file.read(_BLOCK_HEADER.size)
+            if len(header) < _BLOCK_HEADER.size:
+                break
+            compressed_size, _, count, first_timestamp = _BLOCK_HEADER.unpack(header)
+            if len(self._file.read(compressed_size)) < compressed_size:
+                break
+
+            blocks.append(BlockInfo(offset, first_timestamp, records, count))
+            records += count
+            offset += _BLOCK_HEADER.size + compressed_size
+
+        return blocks
+
+    def read_block(self, num: int) -> list[CaptureRecord]:
+        self._file.seek(self.blocks[num].offset)
+        compressed_size, raw_size, count, _ = _BLOCK_HEADER.unpack(self._file.read(_BLOCK_HEADER.size))
+        raw = memoryview(self._decompress(self._file.read(compressed_size)))
+
+        result = []
+        pos = 0
+        for _ in range(count):
+            timestamp, direction, length = _RECORD_HEADER.unpack_from(raw, pos)
+            pos += _RECORD_HEADER.size
+            result.append(CaptureRecord(timestamp, _DIRECTIONS_REV[direction], bytes(raw[pos:pos + length])))
+            pos += length
+
+        return result
+
+    def _iter_from_block(self, num: int) -> Iterator[CaptureRecord]:
+        for block_num in range(max(num, 0), len(self.blocks)):
+            yield from self.read_block(block_num)
+
+    def __iter__(self) -> Iterator[CaptureRecord]:
+        return self._iter_from_block(0)
+
+    def seek_time(self, timestamp: float) -> Iterator[CaptureRecord]:
+        for record in self._iter_from_block(bisect_right(self._timestamps, timestamp) - 1):
+            if record.timestamp >= timestamp:
+                yield record
+
+    def seek_record(self, num: int) -> Iterator[CaptureRecord]:
+        block_num = max(bisect_right(self._first_records, num) - 1, 0)
+        skip = num - self.blocks[block_num].first_record if self.blocks else 0
+        for record in self._iter_from_block(block_num):
+            if skip > 0:
+                skip -= 1
+                continue
+            yield record
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> CaptureReader:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
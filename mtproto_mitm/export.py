@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import json
+import sys
+from array import array
+from pathlib import Path
+from typing import BinaryIO
+
+import click
+from mtproto import ConnectionRole
+from mtproto.transport.packets import MessagePacket
+from socks5server import DataDirection
+
+from mtproto_mitm.capture import CaptureReader
+from mtproto_mitm.main import ConnectionPair, register_keys
+from mtproto_mitm.protocol import MTProto
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COLUMNS = {
+    "auth_key_id": "q",
+    "message_id": "q",
+    "session_id": "q",
+    "seq_no": "I",
+    "direction": "B",
+    "timestamp": "d",
+    "constructor": "I",
+    "decrypted": "B",
+    "size": "I",
+    "body_offset": "Q",
+}
+DTYPES = {"q": "<i8", "Q": "<u8", "I": "<u4", "B": "u1", "d": "<f8"}
+SCHEMA_FILE = "schema.json"
+BODIES_FILE = "bodies.bin"
+
+
+class ColumnarWriter:
+    def __init__(self, directory: Path, bodies: bool = True, flush_rows: int = 64 * 1024):
+        directory.mkdir(parents=True, exist_ok=True)
+        self._directory = directory
+        self._flush_rows = flush_rows
+        self._columns = {name: array(typecode) for name, typecode in COLUMNS.items()}
+        self._files: dict[str, BinaryIO] = {name: open(directory / f"{name}.bin", "wb") for name in COLUMNS}
+        self._bodies = open(directory / BODIES_FILE, "wb") if bodies else None
+        self._body_offset = 0
+        self._pending = 0
+        self.rows = 0
+
+    def append(
+            self, auth_key_id: int, message_id: int | None, session_id: int | None, seq_no: int | None,
+            direction: DataDirection, timestamp: float, body: bytes, decrypted: bool,
+    ) -> None:
+        columns = self._columns
+        columns["auth_key_id"].append(auth_key_id)
+        columns["message_id"].append(message_id or 0)
+        columns["session_id"].append(session_id or 0)
+        columns["seq_no"].append(seq_no or 0)
+        columns["direction"].append(0 if direction is DataDirection.CLIENT_TO_DST else 1)
+        columns["timestamp"].append(timestamp)
+        columns["constructor"].append(int.from_bytes(body[:4], "little") if decrypted and len(body) >= 4 else 0)
+        columns["decrypted"].append(decrypted)
+        columns["size"].append(len(body))
+        columns["body_offset"].append(self._body_offset)
+
+        if self._bodies is not None:
+            self._bodies.write(body)
+            self._body_offset += len(body)
+
+        self._pending += 1
+        self.rows += 1
+        if self._pending >= self._flush_rows:
+            self._flush()
+
+    def _flush(self) -> None:
+        for name, column in self._columns.items():
+            if sys.byteorder == "big":
+                column.byteswap()
+            column.tofile(self._files[name])
+            del column[:]
+        self._pending = 0
+
+    def close(self) -> None:
+        self._flush()
+        for file in self._files.values():
+            file.close()
+        if self._bodies is not None:
+            self._bodies.close()
+
+        with open(self._directory / SCHEMA_FILE, "w") as f:
+            json.dump({
+                "rows": self.rows,
+                "columns": {name: DTYPES[typecode] for name, typecode in COLUMNS.items()},
+                "bodies": self._bodies is not None,
+            }, f, indent=2)
+
+
+def export_capture(path: Path, writer: ColumnarWriter) -> None:
+    conn = ConnectionPair()
+    with CaptureReader(path) as capture:
+        for record in capture:
+            sender = ConnectionRole.CLIENT if record.direction is DataDirection.CLIENT_TO_DST else ConnectionRole.SERVER
+            current, receiver = conn.for_direction(record.direction)
+            current.data_received(record.data)
+
+            while (packet := current.next_event()) is not None:
+                receiver.send(packet)
+                if not isinstance(packet, MessagePacket) or (result := MTProto.decrypt(packet, sender)) is None:
+                    continue
+
+                meta, body, decrypted = result
+                writer.append(
+                    meta.auth_key_id, meta.message_id, meta.session_id, meta.seq_no, record.direction,
+                    record.timestamp, body, decrypted,
+                )
+
+
+def load_columns(directory: Path) -> dict:
+    with open(directory / SCHEMA_FILE) as f:
+        schema = json.load(f)
+
+    result = {}
+    for name, dtype in schema["columns"].items():
+        if numpy is not None:
+            result[name] = numpy.fromfile(directory / f"{name}.bin", dtype=dtype)
+            continue
+
+        column = array(COLUMNS[name])
+        with open(directory / f"{name}.bin", "rb") as f:
+            column.fromfile(f, schema["rows"])
+        if sys.byteorder == "big":
+            column.byteswap()
+        result[name] = column
+
+    return result
+
+
+def read_body(directory: Path, offset: int, size: int) -> bytes:
+    with open(directory / BODIES_FILE, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+@click.command()
+@click.argument("captures", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option("--output", "-o", type=click.STRING, required=True, help="Directory to which columns will be written.")
+@click.option("--key", "-k", type=click.STRING, multiple=True, help="Hex-encoded telegram auth key.")
+@click.option("--keys-file", "-f", type=click.STRING, default=None, help="File with telegram auth keys.")
+@click.option("--no-bodies", is_flag=True, default=False, help="Do not write message bodies.")
+def main(captures: list[Path], output: str, key: list[str], keys_file: str | None, no_bodies: bool):
+    register_keys(key, keys_file)
+
+    writer = ColumnarWriter(Path(output), not no_bodies)
+    for path in captures:
+        export_capture(path, writer)
+    writer.close()
+
+    print(f"Exported {writer.rows} messages from {len(captures)} captures")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+from time import monotonic
+
+from socks5server import PasswordAuthentication, Socks5Client, SocksServer
+from socks5server.auth import NoAuthentication
+
+ANONYMOUS = ""
+
+
+class TokenBucket:
+    __slots__ = ("rate", "_tokens", "_updated",)
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, amount: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+
+        self._refill()
+        self._tokens -= amount
+        return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def available(self) -> bool:
+        if self.rate <= 0:
+            return True
+
+        self._refill()
+        return self._tokens > 0
+
+
+class UserStats:
+    __slots__ = ("connections", "total_connections", "rejected", "bytes", "throttled", "cpu_time", "over_budget",)
+
+    def __init__(self):
+        self.connections = 0
+        self.total_connections = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.throttled = 0.0
+        self.cpu_time = 0.0
+        self.over_budget = 0
+
+    def __repr__(self) -> str:
+        return (
+            f"connections={self.connections} (total {self.total_connections}, rejected {self.rejected}), "
+            f"bytes={self.bytes}, throttled={self.throttled:.1f}s, cpu={self.cpu_time * 1000:.1f}ms, "
+            f"over decode budget={self.over_budget}"
+        )
+
+
+class _User:
+    __slots__ = ("stats", "rate", "decode",)
+
+    def __init__(self, rate: float, decode_budget: float):
+        self.stats = UserStats()
+        self.rate = TokenBucket(rate)
+        self.decode = TokenBucket(decode_budget)
+
+
+class ClientLimiter:
+    def __init__(
+            self, max_connections: int = 0, user_rate: int = 0, connection_rate: int = 0, decode_budget: float = 0,
+    ):
+        self._max_connections = max_connections
+        self._user_rate = user_rate
+        self._connection_rate = connection_rate
+        self._decode_budget = decode_budget
+
+        self._users: dict[str, _User] = {}
+        self._authenticated: dict[asyncio.StreamWriter, str] = {}
+        self._clients: dict[Socks5Client, tuple[_User, TokenBucket]] = {}
+
+    def _user(self, login: str) -> _User:
+        if (user := self._users.get(login)) is None:
+            user = self._users[login] = _User(self._user_rate, self._decode_budget)
+        return user
+
+    @property
+    def decode_limited(self) -> bool:
+        return self._decode_budget > 0
+
+    @property
+    def stats(self) -> dict[str, UserStats]:
+        return {login: user.stats for login, user in self._users.items()}
+
+    def acquire(self, login: str, writer: asyncio.StreamWriter) -> bool:
+        stats = self._user(login).stats
+        if self._max_connections and stats.connections >= self._max_connections:
+            stats.rejected += 1
+            return False
+
+        stats.connections += 1
+        stats.total_connections += 1
+        self._authenticated[writer] = login
+        return True
+
+    def release(self, writer: asyncio.StreamWriter) -> None:
+        if (login := self._authenticated.pop(writer, None)) is not None:
+            self._users[login].stats.connections -= 1
+
+    def discard(self, client: Socks5Client) -> None:
+        self._clients.pop(client, None)
+
+    def _client(self, client: Socks5Client) -> tuple[_User, TokenBucket]:
+        if (state := self._clients.get(client)) is None:
+            login = self._authenticated.get(client.get_rw()[1], ANONYMOUS)
+            state = self._clients[client] = self._user(login), TokenBucket(self._connection_rate)
+        return state
+
+    def throttle(self, client: Socks5Client, size: int) -> float:
+        user, connection_rate = self._client(client)
+        user.stats.bytes += size
+        delay = max(user.rate.consume(size), connection_rate.consume(size))
+        user.stats.throttled += delay
+        return delay
+
+    def decode_allowed(self, client: Socks5Client) -> bool:
+        user, _ = self._client(client)
+        if user.decode.available():
+            return True
+
+        user.stats.over_budget += 1
+        return False
+
+    def account_decode(self, client: Socks5Client, cpu_time: float) -> None:
+        user, _ = self._client(client)
+        user.stats.cpu_time += cpu_time
+        user.decode.consume(cpu_time)
+
+
+class LimitedPasswordAuthentication(PasswordAuthentication):
+    def __init__(self, users: dict[str, str], limiter: ClientLimiter):
+        super().__init__(users)
+        self._limiter = limiter
+
+    def check(self, login: str, password: str, writer: asyncio.StreamWriter) -> bool:
+        return self._users.get(login) == password and self._limiter.acquire(login, writer)
+
+    async def authenticate(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        await reader.read(1)
+        login_len, = await reader.read(1)
+        login = (await reader.read(login_len)).decode("utf8")
+        passw_len, = await reader.read(1)
+        passw = (await reader.read(passw_len)).decode("utf8")
+
+        if not self.check(login, passw, writer):
+            writer.write(b"\x01\xFF")
+            await writer.drain()
+            return False
+
+        writer.write(b"\x01\x00")
+        await writer.drain()
+        return True
+
+
+class LimitedNoAuthentication(NoAuthentication):
+    def __init__(self, limiter: ClientLimiter):
+        self._limiter = limiter
+
+    async def authenticate(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        return self._limiter.acquire(ANONYMOUS, writer)
+
+
+class LimitedSocksServer(SocksServer):
+    def __init__(self, host: str, port: int, no_auth: bool, limiter: ClientLimiter):
+        super().__init__(host, port, no_auth)
+        self._limiter = limiter
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # Disconnect handlers are not called if client fails with anything but Disconnection
+        #  (e.g. when destination is unreachable), so connection slot is released when client is done in any way
+        try:
+            await super().handle_client(reader, writer)
+        finally:
+            self._limiter.release(writer)
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+from asyncio import Event
+from collections import deque
+from enum import IntEnum
+from time import monotonic
+from typing import Hashable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class DecodeLevel(IntEnum):
+    FULL = 0
+    HEADERS = 1
+    SAMPLED = 2
+    RAW = 3
+
+
+class ConnectionStats:
+    __slots__ = ("packets", "bytes", "cpu_time", "levels",)
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.cpu_time = 0.0
+        self.levels = [0] * len(DecodeLevel)
+
+    def __repr__(self) -> str:
+        levels = ", ".join(f"{level.name}={count}" for level, count in zip(DecodeLevel, self.levels) if count)
+        return f"packets={self.packets}, bytes={self.bytes}, cpu={self.cpu_time * 1000:.1f}ms ({levels})"
+
+
+class LoadShedder:
+    def __init__(self, backlog_threshold: int = 256, cpu_budget: float = 0.5, sample_rate: int = 10,
+                 interval: float = 0.5):
+        # Backlog sizes at which decoding is degraded from level N to level N + 1
+        self._thresholds = [backlog_threshold * 4 ** i for i in range(len(DecodeLevel) - 1)]
+        self._cpu_budget = cpu_budget
+        self._sample_rate = sample_rate
+        self._interval = interval
+
+        self.level = DecodeLevel.FULL
+        self.stats: dict[Hashable, ConnectionStats] = {}
+        self._window_start = monotonic()
+        self._window_cpu = 0.0
+        self._backlog = 0
+        self.cpu_usage = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self._thresholds[0] > 0
+
+    def connection_stats(self, key: Hashable) -> ConnectionStats:
+        if (stats := self.stats.get(key)) is None:
+            stats = self.stats[key] = ConnectionStats()
+        return stats
+
+    def level_for(self, key: Hashable) -> DecodeLevel:
+        if self.level is not DecodeLevel.SAMPLED:
+            return self.level
+
+        stats = self.connection_stats(key)
+        return DecodeLevel.HEADERS if stats.packets % self._sample_rate == 0 else DecodeLevel.RAW
+
+    def account(self, key: Hashable, level: DecodeLevel, cpu_time: float) -> None:
+        stats = self.connection_stats(key)
+        stats.packets += 1
+        stats.cpu_time += cpu_time
+        stats.levels[level] += 1
+        self._window_cpu += cpu_time
+
+    def update(self, backlog: int) -> tuple[DecodeLevel, DecodeLevel] | None:
+        self._backlog = max(self._backlog, backlog)
+        now = monotonic()
+        if not self.enabled or now - self._window_start < self._interval:
+            return None
+
+        self.cpu_usage = self._window_cpu / (now - self._window_start)
+        backlog = self._backlog
+        self._window_start = now
+        self._window_cpu = 0.0
+        self._backlog = 0
+
+        old_level = self.level
+        if self.level < DecodeLevel.RAW and (
+                backlog >= self._thresholds[self.level] or self.cpu_usage > self._cpu_budget
+        ):
+            self.level = DecodeLevel(self.level + 1)
+        elif self.level > DecodeLevel.FULL and (
+                backlog < self._thresholds[self.level - 1] // 2 and self.cpu_usage < self._cpu_budget / 2
+        ):
+            self.level = DecodeLevel(self.level - 1)
+
+        return (old_level, self.level) if old_level is not self.level else None
+
+    def busiest(self) -> tuple[Hashable, ConnectionStats] | None:
+        if not self.stats:
+            return None
+        return max(self.stats.items(), key=lambda item: item[1].cpu_time)
+
+    def discard(self, key: Hashable) -> None:
+        self.stats.pop(key, None)
+
+
+class FairQueue(Generic[T]):
+    def __init__(self):
+        self._queues: dict[Hashable, deque[T]] = {}
+        self._ready: deque[Hashable] = deque()
+        self._size = 0
+        self._not_empty = Event()
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return not self._size
+
+    def put_nowait(self, key: Hashable, item: T) -> None:
+        if (queue := self._queues.get(key)) is None:
+            queue = self._queues[key] = deque()
+            self._ready.append(key)
+
+        queue.append(item)
+        self._size += 1
+        self._not_empty.set()
+
+    def get_nowait(self) -> T:
+        key = self._ready.popleft()
+        queue = self._queues[key]
+        item = queue.popleft()
+        if queue:
+            self._ready.append(key)
+        else:
+            del self._queues[key]
+
+        self._size -= 1
+        return item
+
+    async def get(self) -> T:
+        while not self._size:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        return self.get_nowait()
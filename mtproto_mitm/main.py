@@ -1,62 +1,137 @@
 import json
-from asyncio import get_event_loop
+from asyncio import get_event_loop, Task, sleep
 from base64 import b64encode
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from time import time
+from time import time, thread_time, perf_counter_ns, monotonic
 
 import click
 from mtproto import ConnectionRole
 from mtproto.transport import Connection
 from mtproto.transport.packets import ErrorPacket, QuickAckPacket, BasePacket, MessagePacket
-from socks5server import DataDirection, SocksServer, PasswordAuthentication, Socks5Client
-from socks5server.enums import AuthMethod, DataModify
-
-from mtproto_mitm.protocol import MTProto, MessageContainer
+from socks5server import DataDirection, Socks5Client
+from socks5server.enums import AuthMethod
+
+from mtproto_mitm.blobs import BlobStore, BLOB_KEY
+from mtproto_mitm.cache import DecodeCache
+from mtproto_mitm.capture import CaptureWriter
+from mtproto_mitm.limits import (
+    ClientLimiter, LimitedPasswordAuthentication, LimitedNoAuthentication, LimitedSocksServer,
+)
+from mtproto_mitm.load import LoadShedder, DecodeLevel, FairQueue
+from mtproto_mitm.profiling import Tracer, SamplingProfiler, TimedConnection, PacketTrace
+from mtproto_mitm.protocol import MTProto, MessageContainer, MessageStore
+from mtproto_mitm.trigger import TriggerCapture, Trigger
+from mtproto_mitm.timeline import TimelineAggregator, SessionKey
+from mtproto_mitm.tl import TLObject, GzipPacked, SerializationUtils
 
 
 class JsonEncoder(json.JSONEncoder):
+    def __init__(self, *args, blobs: BlobStore | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._blobs = blobs
+
     def default(self, obj):
         if isinstance(obj, bytes):
+            if self._blobs is not None and len(obj) >= self._blobs.threshold:
+                return {BLOB_KEY: self._blobs.put(obj)}
             return obj.hex()
+        elif isinstance(obj, TLObject):
+            return obj.to_dict()
         elif isinstance(obj, int) and obj > 2 ** 53 - 1:
             return str(obj)
         return super().default(obj)
 
 
 class ConnectionPair:
-    __slots__ = ("to_server", "to_client",)
+    __slots__ = ("to_server", "to_client", "passthrough",)
 
     def __init__(self):
         self.to_server: Connection = Connection(ConnectionRole.SERVER)
         self.to_client: Connection = Connection(ConnectionRole.CLIENT)
+        self.passthrough: bool | None = None
+
+    def detect_passthrough(self, data: bytes) -> None:
+        if self.passthrough is not None or not data:
+            return
+
+        # Connection to server always uses plain abridged transport, so if client uses it too,
+        #  re-encoded packets are byte-for-byte identical to received ones and original data can be forwarded as is.
+        # It is decided by first byte before anything is parsed, so that client's header is forwarded
+        #  even if it arrives without a full packet (obfuscated transports never start with 0xef)
+        self.passthrough = data[0] == 0xef
+        if self.passthrough:
+            # Creates client transport without sending its header, client's one is forwarded instead
+            self.to_client.send(None)
+
+    def for_direction(self, direction: DataDirection) -> tuple[Connection, Connection]:
+        if direction is DataDirection.CLIENT_TO_DST:
+            return self.to_server, self.to_client
+        return self.to_client, self.to_server
 
 
 class MitmServer:
     def __init__(
             self, host: str = "0.0.0.0", port: int = 1080, no_auth: bool = False, quiet: bool = False,
-            output_dir: Path | None = None
+            output_dir: Path | None = None, merge_sessions: bool = False, capture: bool = False,
+            blob_threshold: int = 0, triggers: TriggerCapture | None = None, shedder: LoadShedder | None = None,
+            limiter: ClientLimiter | None = None, stats_interval: float = 0,
     ):
-        self._server = SocksServer(host, port, no_auth)
+        self._limiter = limiter if limiter is not None else ClientLimiter()
+        self._server = LimitedSocksServer(host, port, no_auth, self._limiter)
         self._clients: dict[Socks5Client, ConnectionPair] = {}
-        self._sessions: dict[Socks5Client, list[MessageContainer]] = {}
+        self._sessions: dict[Socks5Client, MessageStore] = {}
         self._quiet = quiet
+        # Merged timelines are only drained when they are saved, so without output directory they would never be freed
+        merge_sessions = merge_sessions and output_dir is not None
+        self._shedder = shedder if shedder is not None else LoadShedder(0)
+        # If decoded objects are not needed right away, message bodies are decoded only when they are saved.
+        #  Load shedding and decode budgets need decoding time to be measured on analysis path, so they disable it
+        self._defer_decode = (
+                quiet and triggers is None and not merge_sessions and not self._shedder.enabled
+                and not self._limiter.decode_limited
+        )
         self._output_dir = output_dir
-        self._output_dir.mkdir(parents=True, exist_ok=True)
-
+        if self._output_dir is not None:
+            self._output_dir.mkdir(parents=True, exist_ok=True)
+        self._timelines = TimelineAggregator() if merge_sessions else None
+        # Timelines of one session are appended to the same file, so they are written by single thread in drain order
+        self._timeline_executor = ThreadPoolExecutor(max_workers=1) if merge_sessions else None
+        self._triggers = triggers
+        self._stats_interval = stats_interval
+        # Packets are queued with time they were received at, since analysis may lag behind proxying
+        self._analysis: FairQueue[tuple[Socks5Client, DataDirection | None, BasePacket | None, float]] = FairQueue()
+        self._tasks: set[Task] = set()
+        self._blobs = None
+        if blob_threshold > 0 and self._output_dir is not None:
+            self._blobs = BlobStore(self._output_dir / "blobs", blob_threshold)
+        self._captures: dict[Socks5Client, CaptureWriter] | None = None
+        self._capture_executor: ThreadPoolExecutor | None = None
+        self._capture_counter = 0
+        if capture and self._output_dir is not None:
+            self._captures = {}
+            self._capture_executor = ThreadPoolExecutor(max_workers=1)
+
+        if no_auth:
+            self._server.register_authentication(AuthMethod.NO_AUTH, LimitedNoAuthentication(self._limiter))
         self._server.on_client_disconnected(self._on_disconnect)
         self._server.on_data_modify(self._on_data)
 
     def set_proxy_users(self, users: dict[str, str]):
-        self._server.register_authentication(AuthMethod.PASSWORD, PasswordAuthentication(users))
-
-    def _handle_packet(self, client: Socks5Client, packet: BasePacket, direction: DataDirection) -> None:
+        self._server.register_authentication(
+            AuthMethod.PASSWORD, LimitedPasswordAuthentication(users, self._limiter),
+        )
+
+    def _handle_packet(
+            self, client: Socks5Client, packet: BasePacket, direction: DataDirection, received: float,
+            level: DecodeLevel = DecodeLevel.FULL,
+    ) -> None:
         sender = ConnectionRole.CLIENT if direction is DataDirection.CLIENT_TO_DST else ConnectionRole.SERVER
         arrow = "->" if direction is DataDirection.CLIENT_TO_DST else "<-"
 
         message = None
         if isinstance(packet, MessagePacket):
-            message = MTProto.read_object(packet, sender)
+            message = self._decode(packet, sender, level)
 
         if isinstance(packet, ErrorPacket):
             if not self._quiet:
@@ -68,74 +143,217 @@ class MitmServer:
             if not self._quiet:
                 print(f" {arrow} UNKNOWN({packet!r}")
         else:
-            self._sessions[client].append(message)
             if not self._quiet:
-                print(f" {arrow} {message}")
-
-    async def _on_data(self, client: Socks5Client, direction: DataDirection, data: bytes) -> DataModify | None:
+                self._render(arrow, message)
+            if self._triggers is None:
+                self._record(client, direction, message, level)
+                return
+
+            trigger, messages = self._triggers.process(client, (direction, level), message, received)
+            if trigger is not None and not self._quiet:
+                print(f" !! Trigger {trigger.spec!r} matched, recording {len(messages)} buffered messages")
+            for (message_direction, message_level), buffered_message in messages:
+                self._record(client, message_direction, buffered_message, message_level)
+
+    def _decode(self, packet: MessagePacket, sender: ConnectionRole, level: DecodeLevel) -> MessageContainer | None:
+        if level is DecodeLevel.FULL and not self._defer_decode:
+            return MTProto.read_object(packet, sender)
+        elif level is DecodeLevel.FULL or level is DecodeLevel.HEADERS:
+            return MTProto.read_header(packet, sender)
+        return MTProto.read_raw(packet)
+
+    def _render(self, arrow: str, message: MessageContainer) -> None:
+        print(f" {arrow} {message}")
+
+    def _record(
+            self, client: Socks5Client, direction: DataDirection, message: MessageContainer, level: DecodeLevel,
+    ) -> None:
+        self._sessions[client].append(message, level is DecodeLevel.FULL)
+        if self._timelines is not None:
+            self._timelines.add((client, direction), message)
+
+    def _analyze_packet(
+            self, client: Socks5Client, packet: BasePacket, direction: DataDirection, received: float,
+    ) -> None:
+        if (level_change := self._shedder.update(self._analysis.qsize())) is not None:
+            self._log_level_change(*level_change)
+
+        level = self._shedder.level_for(client)
+        if level is not DecodeLevel.RAW and not self._limiter.decode_allowed(client):
+            level = DecodeLevel.RAW
+
+        start = thread_time()
+        self._handle_packet(client, packet, direction, received, level)
+        cpu_time = thread_time() - start
+        self._shedder.account(client, level, cpu_time)
+        self._limiter.account_decode(client, cpu_time)
+
+    def _log_level_change(self, old: DecodeLevel, new: DecodeLevel) -> None:
+        print(
+            f" !! Decode level changed: {old.name} -> {new.name} "
+            f"(backlog: {self._analysis.qsize()}, analysis cpu usage: {self._shedder.cpu_usage:.0%})"
+        )
+        if (busiest := self._shedder.busiest()) is not None:
+            print(f" !! Busiest connection: {busiest[0]!r}: {busiest[1]!r}")
+
+    def _process(
+            self, client: Socks5Client, direction: DataDirection | None, packet: BasePacket | None, received: float,
+    ) -> None:
+        # Malformed packet of one connection must not stop analysis of all others
+        try:
+            if packet is None:
+                self._finish_client(client)
+            else:
+                self._analyze_packet(client, packet, direction, received)
+        except Exception as e:
+            print(f" !! Failed to analyze packet of {client!r}: {e!r}")
+
+    async def _analyze(self) -> None:
+        while True:
+            client, direction, packet, received = await self._analysis.get()
+            self._process(client, direction, packet, received)
+            if packet is None:
+                self._run_task(self._save(client))
+
+            # FairQueue.get does not yield to event loop if there are items in queue
+            await sleep(0)
+
+    def _print_stats(self) -> None:
+        print(f" ** Decode level: {self._shedder.level.name}, backlog: {self._analysis.qsize()}")
+        for login, stats in self._limiter.stats.items():
+            print(f" ** User {login or '<anonymous>'!r}: {stats!r}")
+        if MTProto.cache is not None:
+            print(f" ** Decode cache: {MTProto.cache.stats!r}")
+
+    async def _print_stats_periodically(self) -> None:
+        while True:
+            await sleep(self._stats_interval)
+            self._print_stats()
+
+    def _run_task(self, coro) -> None:
+        task = get_event_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _on_data(self, client: Socks5Client, direction: DataDirection, data: bytes) -> bytes | None:
         if client not in self._clients:
-            self._clients[client] = ConnectionPair()
-            self._sessions[client] = []
+            self._clients[client] = self._new_connection_pair()
+            self._sessions[client] = MessageStore()
+            if self._captures is not None:
+                self._captures[client] = self._new_capture()
+
+        if self._captures is not None and data:
+            self._captures[client].write(direction, data)
+        self._shedder.connection_stats(client).bytes += len(data)
 
         conn = self._clients[client]
 
-        current = conn.to_server if direction is DataDirection.CLIENT_TO_DST else conn.to_client
-        receiver = conn.to_client if direction is DataDirection.CLIENT_TO_DST else conn.to_server
+        current, receiver = conn.for_direction(direction)
 
+        if direction is DataDirection.CLIENT_TO_DST:
+            conn.detect_passthrough(data)
         current.data_received(data)
 
-        to_send = b""
-
+        to_send = []
+        received = monotonic()
         while (packet := current.next_event()) is not None:
-            self._handle_packet(client, packet, direction)
-            to_send += receiver.send(packet)
+            self._analysis.put_nowait(client, (client, direction, packet, received))
+            if not conn.passthrough:
+                to_send.append(receiver.send(packet))
+
+        # Empty data is only sent on disconnect, so it must not delay saving of connection
+        if data and (delay := self._limiter.throttle(client, len(data))) > 0:
+            await sleep(delay)
+
+        if conn.passthrough:
+            return None
+        return b"".join(to_send)
 
-        return to_send
+    def _new_connection_pair(self) -> ConnectionPair:
+        return ConnectionPair()
+
+    def _new_capture(self) -> CaptureWriter:
+        self._capture_counter += 1
+        path = self._output_dir / f"{int(time() * 1000)}_{self._capture_counter}.mtcap"
+        return CaptureWriter(path, self._capture_executor)
 
     async def _on_disconnect(self, client: Socks5Client) -> None:
         if client not in self._clients:
             return
         if client not in self._sessions:
-            self._sessions[client] = []
+            self._sessions[client] = MessageStore()
 
         await self._on_data(client, DataDirection.CLIENT_TO_DST, b"")
         await self._on_data(client, DataDirection.DST_TO_CLIENT, b"")
 
         del self._clients[client]
-        await self._save(client)
+        if self._captures is not None:
+            self._captures.pop(client).close()
+        self._analysis.put_nowait(client, (client, None, None, monotonic()))
+
+    def _finish_client(self, client: Socks5Client) -> None:
+        if self._triggers is not None:
+            self._triggers.discard(client)
+        if self._timelines is not None:
+            self._timelines.close((client, DataDirection.CLIENT_TO_DST))
+            self._timelines.close((client, DataDirection.DST_TO_CLIENT))
+        self._shedder.discard(client)
+        self._limiter.discard(client)
 
     async def run_async(self) -> None:
+        self._run_task(self._analyze())
+        if self._stats_interval > 0:
+            self._run_task(self._print_stats_periodically())
         await self._server.serve()
 
-    def _sync_save(self, messages: list[MessageContainer] | None) -> None:
+    @staticmethod
+    def _message_to_dict(message: MessageContainer) -> dict:
+        return {
+            "metadata": {
+                "auth_key_id": message.meta.auth_key_id,
+                "message_id": message.meta.message_id,
+                "session_id": message.meta.session_id,
+                "salt": message.meta.salt,
+                "seq_no": message.meta.seq_no,
+                "msg_key": message.meta.msg_key,
+            },
+            "object": message.obj.to_dict() if message.obj is not None else None,
+            "raw_data": b64encode(message.raw_data) if message.obj is None and message.raw_data is not None else None,
+        }
+
+    def _sync_save(self, messages: MessageStore | None) -> None:
         if messages is None:
             return
 
-        messages_json = []
-        for message in messages:
-            messages_json.append({
-                "metadata": {
-                    "auth_key_id": message.meta.auth_key_id,
-                    "message_id": message.meta.message_id,
-                    "session_id": message.meta.session_id,
-                    "salt": message.meta.salt,
-                    "seq_no": message.meta.seq_no,
-                    "msg_key": message.meta.msg_key,
-                },
-                "object": message.obj.to_dict() if message.obj is not None else None,
-                "raw_data": b64encode(message.raw_data) if message.raw_data is not None else None,
-            })
+        messages_json = [self._message_to_dict(message) for message in messages]
 
         sid = hex(messages_json[-1]["metadata"]["session_id"] or 0)[2:6] if messages_json else "0000"
         with open(self._output_dir / f"{int(time()*1000)}_{sid}.json", "w") as f:
-            json.dump(messages_json, f, cls=JsonEncoder, indent=2)
+            json.dump(messages_json, f, cls=JsonEncoder, indent=2, blobs=self._blobs)
 
     async def _save(self, client: Socks5Client) -> None:
         if not self._output_dir:
             return
 
+        timelines = None
+        if self._timelines is not None:
+            timelines = get_event_loop().run_in_executor(
+                self._timeline_executor, self._sync_save_timelines, list(self._timelines.drain()),
+            )
+
         with ThreadPoolExecutor() as pool:
             await get_event_loop().run_in_executor(pool, self._sync_save, self._sessions.pop(client, None))
+        if timelines is not None:
+            await timelines
+
+    def _sync_save_timelines(self, timelines: list[tuple[SessionKey, list[MessageContainer]]]) -> None:
+        for (auth_key_id, session_id), messages in timelines:
+            # Ids are signed, so they are formatted as unsigned to keep names of all files in the same format
+            name = f"{auth_key_id & 0xFFFFFFFFFFFFFFFF:016x}_{session_id & 0xFFFFFFFFFFFFFFFF:016x}"
+            with open(self._output_dir / f"{name}.jsonl", "a") as f:
+                for message in messages:
+                    f.write(json.dumps(self._message_to_dict(message), cls=JsonEncoder, blobs=self._blobs))
+                    f.write("\n")
 
     def run(self) -> None:
         try:
@@ -143,6 +361,18 @@ class MitmServer:
         except KeyboardInterrupt:
             pass
 
+        while not self._analysis.empty():
+            self._process(*self._analysis.get_nowait())
+
+        if self._stats_interval > 0:
+            self._print_stats()
+
+        if self._captures is not None:
+            for capture in self._captures.values():
+                capture.close()
+            self._captures.clear()
+            self._capture_executor.shutdown(wait=True)
+
         if not self._output_dir:
             return
 
@@ -152,6 +382,100 @@ class MitmServer:
         for client in list(self._sessions.keys()):
             self._sync_save(self._sessions.pop(client, None))
 
+        if self._timelines is not None:
+            self._timeline_executor.shutdown(wait=True)
+            self._timelines.close_all()
+            self._sync_save_timelines(list(self._timelines.drain()))
+
+
+class ProfilingMitmServer(MitmServer):
+    def __init__(self, *args, tracer: Tracer, profiler: SamplingProfiler | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tracer = tracer
+        self._profiler = profiler
+        self._connection_ids: dict[Socks5Client, int] = {}
+        self._trace: PacketTrace | None = None
+        # Parsing is traced on analysis path
+        self._defer_decode = False
+
+    def _new_connection_pair(self) -> ConnectionPair:
+        pair = ConnectionPair()
+        pair.to_server = TimedConnection(pair.to_server, self._tracer)
+        pair.to_client = TimedConnection(pair.to_client, self._tracer)
+        return pair
+
+    def _analyze_packet(
+            self, client: Socks5Client, packet: BasePacket, direction: DataDirection, received: float,
+    ) -> None:
+        if (trace := self._tracer.pop(packet)) is None:
+            return super()._analyze_packet(client, packet, direction, received)
+
+        trace.queue = max(perf_counter_ns() - trace.created - trace.send, 0)
+        self._trace = trace
+        try:
+            super()._analyze_packet(client, packet, direction, received)
+        finally:
+            self._trace = None
+
+        if client not in self._connection_ids:
+            self._connection_ids[client] = len(self._connection_ids)
+        self._tracer.write(trace, self._connection_ids[client], direction is DataDirection.DST_TO_CLIENT)
+
+    def _decode(self, packet: MessagePacket, sender: ConnectionRole, level: DecodeLevel) -> MessageContainer | None:
+        trace = self._trace
+        if trace is None:
+            return super()._decode(packet, sender, level)
+
+        trace.level = level
+        start = perf_counter_ns()
+        if level is not DecodeLevel.FULL:
+            message = super()._decode(packet, sender, level)
+            trace.decrypt = perf_counter_ns() - start
+            return message
+
+        result = MTProto.decrypt(packet, sender)
+        decrypted = perf_counter_ns()
+        message = MTProto.parse(*result) if result is not None else None
+        trace.decrypt = decrypted - start
+        trace.parse = perf_counter_ns() - decrypted
+        return message
+
+    def _render(self, arrow: str, message: MessageContainer) -> None:
+        start = perf_counter_ns()
+        super()._render(arrow, message)
+        if self._trace is not None:
+            self._trace.render += perf_counter_ns() - start
+
+    def _record(
+            self, client: Socks5Client, direction: DataDirection, message: MessageContainer, level: DecodeLevel,
+    ) -> None:
+        start = perf_counter_ns()
+        super()._record(client, direction, message, level)
+        if self._trace is not None:
+            self._trace.record += perf_counter_ns() - start
+
+    def run(self) -> None:
+        if self._profiler is not None:
+            self._profiler.start()
+
+        super().run()
+
+        if self._profiler is not None:
+            self._profiler.stop()
+        self._tracer.close()
+        print(self._tracer.summary())
+
+
+def register_keys(keys: list[str], keys_file: str | None) -> None:
+    for k in keys:
+        MTProto.register_key(bytes.fromhex(k))
+
+    if keys_file:
+        with open(keys_file) as f:
+            keys = f.read().splitlines()
+        for k in keys:
+            MTProto.register_key(bytes.fromhex(k))
+
 
 @click.command()
 @click.option("--host", "-h", type=click.STRING, default="0.0.0.0", help="Proxy host to run on.")
@@ -163,21 +487,83 @@ class MitmServer:
               help="Directory to which mtproto requests will be saved.")
 @click.option("--proxy-no-auth", is_flag=True, default=False, help="Disable authentication for proxy.")
 @click.option("--proxy-user", type=click.STRING, multiple=True, help="Proxy user in login:password format.")
+@click.option("--merge-sessions", is_flag=True, default=False,
+              help="Also save messages merged by session across all connections.")
+@click.option("--lazy-gzip", is_flag=True, default=False,
+              help="Keep gzip-packed objects compressed until they are accessed.")
+@click.option("--gzip-max-size", type=click.INT, default=GzipPacked.max_unpacked_size,
+              help="Maximum size of decompressed gzip-packed object.")
+@click.option("--capture", is_flag=True, default=False,
+              help="Also record raw traffic of every connection to compressed capture files.")
+@click.option("--blob-threshold", type=click.INT, default=0,
+              help="Save bytes values of at least this size only once, to output/blobs (0 to disable).")
+@click.option("--trigger", type=click.STRING, multiple=True,
+              help="Only save messages around ones matching this trigger, in name[:field=value] format.")
+@click.option("--trigger-buffer", type=click.INT, default=256,
+              help="Number of messages per connection to save before trigger match.")
+@click.option("--trigger-post", type=click.FLOAT, default=10.0,
+              help="Number of seconds to save messages after trigger match.")
+@click.option("--shed-backlog", type=click.INT, default=256,
+              help="Number of pending packets at which decoding starts to degrade (0 to always decode fully).")
+@click.option("--shed-cpu", type=click.FLOAT, default=0.5,
+              help="Fraction of time that may be spent decoding before decoding starts to degrade.")
+@click.option("--sample-rate", type=click.INT, default=10,
+              help="Decode only every Nth packet of connection when decoding is sampled.")
+@click.option("--max-connections", type=click.INT, default=0,
+              help="Maximum number of concurrent connections per proxy user (0 for unlimited).")
+@click.option("--user-rate", type=click.INT, default=0,
+              help="Maximum bytes per second per proxy user (0 for unlimited).")
+@click.option("--connection-rate", type=click.INT, default=0,
+              help="Maximum bytes per second per connection (0 for unlimited).")
+@click.option("--decode-budget", type=click.FLOAT, default=0,
+              help="Seconds of decoding per second per proxy user, packets over budget are not decoded "
+                   "(0 for unlimited).")
+@click.option("--stats-interval", type=click.FLOAT, default=0,
+              help="Interval in seconds to print per-user statistics at (0 to disable).")
+@click.option("--decode-cache", type=click.INT, default=0,
+              help="Number of decoded small payloads and objects to keep for reuse (0 to disable).")
+@click.option("--decode-cache-size", type=click.INT, default=1024,
+              help="Maximum size of payload or object to be cached.")
+@click.option("--profile", type=click.STRING, default=None,
+              help="File to which per-packet processing stage timings will be saved.")
+@click.option("--profile-stacks", type=click.STRING, default=None,
+              help="File to which sampled stacks will be saved in collapsed (flamegraph) format, requires --profile.")
+@click.option("--profile-interval", type=click.FLOAT, default=5.0, help="Stack sampling interval in milliseconds.")
 def main(host: str, port: int, key: list[str], keys_file: str, quiet: bool, output: str | None, proxy_no_auth: bool,
-         proxy_user: list[str]):
+         proxy_user: list[str], merge_sessions: bool, lazy_gzip: bool, gzip_max_size: int, capture: bool,
+         blob_threshold: int, trigger: list[str], trigger_buffer: int, trigger_post: float, shed_backlog: int,
+         shed_cpu: float, sample_rate: int, max_connections: int, user_rate: int, connection_rate: int,
+         decode_budget: float, stats_interval: float, decode_cache: int, decode_cache_size: int,
+         profile: str | None, profile_stacks: str | None, profile_interval: float):
+    if profile_stacks is not None and profile is None:
+        raise click.UsageError("--profile-stacks requires --profile.")
+
     if not quiet:
         print("Running...")
 
-    for k in key:
-        MTProto.register_key(bytes.fromhex(k))
-
-    if keys_file:
-        with open(keys_file) as f:
-            keys = f.read().splitlines()
-        for k in keys:
-            MTProto.register_key(bytes.fromhex(k))
-
-    server = MitmServer(host, port, proxy_no_auth, quiet, Path(output) if output is not None else None)
+    GzipPacked.lazy = lazy_gzip
+    GzipPacked.max_unpacked_size = gzip_max_size
+    if decode_cache > 0:
+        MTProto.cache = SerializationUtils.interner = DecodeCache(decode_cache, decode_cache_size)
+
+    register_keys(key, keys_file)
+
+    triggers = None
+    if trigger:
+        triggers = TriggerCapture([Trigger(spec) for spec in trigger], trigger_buffer, trigger_post)
+
+    server_args = (
+        host, port, proxy_no_auth, quiet, Path(output) if output is not None else None, merge_sessions, capture,
+        blob_threshold, triggers, LoadShedder(shed_backlog, shed_cpu, sample_rate),
+        ClientLimiter(max_connections, user_rate, connection_rate, decode_budget), stats_interval,
+    )
+    if profile is not None:
+        profiler = None
+        if profile_stacks is not None:
+            profiler = SamplingProfiler(Path(profile_stacks), profile_interval / 1000)
+        server = ProfilingMitmServer(*server_args, tracer=Tracer(Path(profile)), profiler=profiler)
+    else:
+        server = MitmServer(*server_args)
     if proxy_user:
         server.set_proxy_users({login: password for user in proxy_user for login, password in [user.split(":")]})
 
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import struct
+import sys
+from collections import Counter
+from pathlib import Path
+from threading import Thread, Event, main_thread
+from time import perf_counter_ns, time
+from typing import Iterator, NamedTuple
+
+from mtproto.transport import Connection
+from mtproto.transport.packets import BasePacket
+
+TRACE_MAGIC = b"MTMT"
+TRACE_VERSION = 1
+STAGES = ("receive", "frame", "queue", "decrypt", "parse", "render", "record", "send")
+
+_TRACE_HEADER = struct.Struct("<4sB")
+_TRACE_RECORD = struct.Struct(f"<dIBB{len(STAGES)}I")
+_MAX_DURATION = 2 ** 32 - 1
+
+
+class PacketTrace:
+    __slots__ = ("timestamp", "created", "level", *STAGES,)
+
+    def __init__(self):
+        self.timestamp = time()
+        self.created = perf_counter_ns()
+        self.level = 0
+        for stage in STAGES:
+            setattr(self, stage, 0)
+
+
+class TraceRecord(NamedTuple):
+    timestamp: float
+    connection: int
+    direction: int
+    level: int
+    stages: dict[str, int]
+
+
+class Tracer:
+    def __init__(self, path: Path):
+        self._file = open(path, "wb", buffering=1024 * 1024)
+        self._file.write(_TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self._pending: dict[int, PacketTrace] = {}
+        self._totals = [0] * len(STAGES)
+        self._maximums = [0] * len(STAGES)
+        self.packets = 0
+
+    def start(self, packet: BasePacket) -> PacketTrace:
+        trace = self._pending[id(packet)] = PacketTrace()
+        return trace
+
+    def get(self, packet: BasePacket) -> PacketTrace | None:
+        return self._pending.get(id(packet))
+
+    def pop(self, packet: BasePacket) -> PacketTrace | None:
+        return self._pending.pop(id(packet), None)
+
+    def write(self, trace: PacketTrace, connection: int, direction: int) -> None:
+        durations = [min(getattr(trace, stage), _MAX_DURATION) for stage in STAGES]
+        self._file.write(_TRACE_RECORD.pack(trace.timestamp, connection, direction, trace.level, *durations))
+
+        self.packets += 1
+        for i, duration in enumerate(durations):
+            self._totals[i] += duration
+            self._maximums[i] = max(self._maximums[i], duration)
+
+    def summary(self) -> str:
+        lines = [f"Traced {self.packets} packets:"]
+        for stage, total, maximum in zip(STAGES, self._totals, self._maximums):
+            mean = total / self.packets if self.packets else 0
+            lines.append(
+                f"  {stage:>8}: total {total / 1e6:10.1f}ms, mean {mean / 1e3:8.1f}us, max {maximum / 1e3:8.1f}us"
+            )
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_trace(path: Path) -> Iterator[TraceRecord]:
+    with open(path, "rb") as f:
+        magic, version = _TRACE_HEADER.unpack(f.read(_TRACE_HEADER.size))
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError(f"{path} is not a trace file")
+
+        while len(data := f.read(_TRACE_RECORD.size)) == _TRACE_RECORD.size:
+            timestamp, connection, direction, level, *durations = _TRACE_RECORD.unpack(data)
+            yield TraceRecord(timestamp, connection, direction, level, dict(zip(STAGES, durations)))
+
+
+class TimedConnection:
+    __slots__ = ("_conn", "_tracer", "_received",)
+
+    def __init__(self, conn: Connection, tracer: Tracer):
+        self._conn = conn
+        self._tracer = tracer
+        self._received = 0
+
+    def data_received(self, data: bytes | None) -> None:
+        start = perf_counter_ns()
+        self._conn.data_received(data)
+        self._received += perf_counter_ns() - start
+
+    def next_event(self) -> BasePacket | None:
+        start = perf_counter_ns()
+        packet = self._conn.next_event()
+        elapsed = perf_counter_ns() - start
+
+        if packet is not None:
+            trace = self._tracer.start(packet)
+            trace.receive = self._received
+            trace.frame = elapsed
+            self._received = 0
+
+        return packet
+
+    def send(self, packet: BasePacket | None) -> bytes:
+        start = perf_counter_ns()
+        data = self._conn.send(packet)
+        if packet is not None and (trace := self._tracer.get(packet)) is not None:
+            trace.send += perf_counter_ns() - start
+
+        return data
+
+
+class SamplingProfiler:
+    def __init__(self, path: Path, interval: float = 0.005, thread_id: int | None = None):
+        self._path = path
+        self._interval = interval
+        self._thread_id = thread_id if thread_id is not None else main_thread().ident
+        self._stacks: Counter[str] = Counter()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="mtproto-mitm-sampler", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+
+            if stack:
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+        # Collapsed stacks format, can be passed directly to flamegraph.pl, speedscope, etc.
+        with open(self._path, "w") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
@@ -1,9 +1,13 @@
+from array import array
 from hashlib import sha1
 from io import BytesIO
+from typing import Iterator
 
 from mtproto import ConnectionRole
 from mtproto.transport.packets import MessagePacket, UnencryptedMessagePacket, EncryptedMessagePacket
 
+from mtproto_mitm import tl
+from mtproto_mitm.cache import DecodeCache
 from mtproto_mitm.tl import TLObject
 
 
@@ -47,12 +51,23 @@ class MessageContainer:
         self.raw_data = raw_data
         self.raw_data_decrypted = raw_data_decrypted
 
+    @property
+    def constructor(self) -> int | None:
+        if self.obj is not None:
+            return self.obj.tlid()
+        if self.raw_data_decrypted and self.raw_data is not None and len(self.raw_data) >= 4:
+            return int.from_bytes(self.raw_data[:4], "little")
+
     def __repr__(self) -> str:
+        if self.obj is None and (constructor := self.constructor) is not None:
+            name = tl.all.objects[constructor].tlname() if constructor in tl.all.objects else hex(constructor)
+            return f"MessageContainer(meta={self.meta!r}, constructor={name})"
         return f"MessageContainer(meta={self.meta!r}, obj={self.obj!r})"
 
 
 class MTProto:
     _auth_keys = {}
+    cache: DecodeCache | None = None
 
     @classmethod
     def register_key(cls, auth_key: bytes) -> None:
@@ -61,29 +76,17 @@ class MTProto:
         cls._auth_keys[auth_key_id] = auth_key
 
     @classmethod
-    def read_object(cls, message: MessagePacket, sender: ConnectionRole = ConnectionRole.CLIENT) -> MessageContainer:
+    def decrypt(
+            cls, message: MessagePacket, sender: ConnectionRole = ConnectionRole.CLIENT
+    ) -> tuple[MessageMetadata, bytes, bool] | None:
         if isinstance(message, UnencryptedMessagePacket):
-            raw_data = message.message_data
-            try:
-                obj = TLObject.read(BytesIO(raw_data))
-                raw_data = None
-            except RuntimeError as e:
-                print(e)
-                obj = None
-
-            return MessageContainer(
-                meta=MessageMetadata(0, message.message_id),
-                obj=obj,
-                raw_data=raw_data,
-                raw_data_decrypted=True,
-            )
+            return MessageMetadata(0, message.message_id), message.message_data, True
         elif isinstance(message, EncryptedMessagePacket):
-            failed_to_decrypt_result = MessageContainer(
-                    meta=MessageMetadata(message.auth_key_id, None, msg_key=message.message_key),
-                    obj=None,
-                    raw_data=message.encrypted_data,
-                    raw_data_decrypted=False,
-                )
+            failed_to_decrypt_result = (
+                MessageMetadata(message.auth_key_id, None, msg_key=message.message_key),
+                message.encrypted_data,
+                False,
+            )
 
             if message.auth_key_id not in cls._auth_keys:
                 return failed_to_decrypt_result
@@ -93,22 +96,157 @@ class MTProto:
             except ValueError:
                 return failed_to_decrypt_result
 
-            raw_data = decrypted.data
-            try:
-                obj = TLObject.read(BytesIO(raw_data))
-                raw_data = None
-            except RuntimeError:
-                obj = None
+            meta = MessageMetadata(
+                auth_key_id=message.auth_key_id,
+                message_id=decrypted.message_id,
+                session_id=decrypted.session_id,
+                salt=decrypted.salt,
+                seq_no=decrypted.seq_no,
+            )
+            return meta, decrypted.data, True
 
+    @classmethod
+    def read_header(cls, message: MessagePacket, sender: ConnectionRole = ConnectionRole.CLIENT) -> MessageContainer | None:
+        if (result := cls.decrypt(message, sender)) is None:
+            return None
+
+        meta, raw_data, decrypted = result
+        return MessageContainer(meta=meta, obj=None, raw_data=raw_data, raw_data_decrypted=decrypted)
+
+    @classmethod
+    def read_raw(cls, message: MessagePacket) -> MessageContainer | None:
+        if isinstance(message, UnencryptedMessagePacket):
             return MessageContainer(
-                meta=MessageMetadata(
-                    auth_key_id=message.auth_key_id,
-                    message_id=decrypted.message_id,
-                    session_id=decrypted.session_id,
-                    salt=decrypted.salt,
-                    seq_no=decrypted.seq_no,
-                ),
-                obj=obj,
-                raw_data=raw_data,
+                meta=MessageMetadata(0, message.message_id),
+                obj=None,
+                raw_data=message.message_data,
                 raw_data_decrypted=True,
             )
+        elif isinstance(message, EncryptedMessagePacket):
+            return MessageContainer(
+                meta=MessageMetadata(message.auth_key_id, None, msg_key=message.message_key),
+                obj=None,
+                raw_data=message.encrypted_data,
+                raw_data_decrypted=False,
+            )
+
+    @classmethod
+    def read_object(cls, message: MessagePacket, sender: ConnectionRole = ConnectionRole.CLIENT) -> MessageContainer | None:
+        if (result := cls.decrypt(message, sender)) is None:
+            return None
+
+        return cls.parse(*result)
+
+    @classmethod
+    def _read(cls, raw_data: bytes) -> TLObject:
+        if cls.cache is None or len(raw_data) > cls.cache.max_size:
+            return TLObject.read(BytesIO(raw_data))
+
+        raw_data = bytes(raw_data)
+        if (obj := cls.cache.get(raw_data)) is None:
+            obj = TLObject.read(BytesIO(raw_data))
+            cls.cache.put(raw_data, obj)
+        return obj
+
+    @classmethod
+    def parse(cls, meta: MessageMetadata, raw_data: bytes, decrypted: bool) -> MessageContainer:
+        obj = None
+        if decrypted:
+            try:
+                obj = cls._read(raw_data)
+                raw_data = None
+            except RuntimeError as e:
+                if meta.auth_key_id == 0:
+                    print(e)
+
+        return MessageContainer(meta=meta, obj=obj, raw_data=raw_data, raw_data_decrypted=decrypted)
+
+
+_HAS_MESSAGE_ID = 1
+_HAS_SESSION = 2
+_DECRYPTED = 4
+_DECODE = 8
+_HAS_MSG_KEY = 16
+
+
+class MessageStore:
+    # Compact storage of connection's messages: metadata is kept in typed arrays and bodies are kept serialized
+    #  in single buffer, message objects are only created (and bodies decoded) when messages are read
+    __slots__ = (
+        "_auth_key_ids", "_message_ids", "_session_ids", "_seq_nos", "_flags", "_salts", "_msg_keys", "_objects",
+        "_offsets", "_bodies",
+    )
+
+    def __init__(self):
+        self._auth_key_ids = array("q")
+        self._message_ids = array("q")
+        self._session_ids = array("q")
+        self._seq_nos = array("i")
+        self._flags = array("B")
+        self._salts = bytearray()
+        self._msg_keys = bytearray()
+        # Objects of messages that were already decoded when they were added, bodies of such messages are not stored
+        self._objects: dict[int, TLObject] = {}
+        self._offsets = array("Q", [0])
+        self._bodies = bytearray()
+
+    def __len__(self) -> int:
+        return len(self._flags)
+
+    def append(self, message: MessageContainer, decode: bool) -> None:
+        meta = message.meta
+        flags = 0
+        if meta.message_id is not None:
+            flags |= _HAS_MESSAGE_ID
+        if meta.session_id is not None:
+            flags |= _HAS_SESSION
+        if message.raw_data_decrypted:
+            flags |= _DECRYPTED
+            if decode:
+                flags |= _DECODE
+        if meta.msg_key is not None:
+            flags |= _HAS_MSG_KEY
+        if message.obj is not None:
+            self._objects[len(self)] = message.obj
+
+        self._auth_key_ids.append(meta.auth_key_id)
+        self._message_ids.append(meta.message_id or 0)
+        self._session_ids.append(meta.session_id or 0)
+        self._seq_nos.append(meta.seq_no or 0)
+        self._flags.append(flags)
+        self._salts += meta.salt or bytes(8)
+        self._msg_keys += meta.msg_key or bytes(16)
+        if message.obj is None:
+            self._bodies += message.raw_data
+        self._offsets.append(len(self._bodies))
+
+    def meta(self, index: int) -> MessageMetadata:
+        flags = self._flags[index]
+        has_session = flags & _HAS_SESSION
+        return MessageMetadata(
+            auth_key_id=self._auth_key_ids[index],
+            message_id=self._message_ids[index] if flags & _HAS_MESSAGE_ID else None,
+            session_id=self._session_ids[index] if has_session else None,
+            salt=bytes(self._salts[index * 8:index * 8 + 8]) if has_session else None,
+            seq_no=self._seq_nos[index] if has_session else None,
+            msg_key=bytes(self._msg_keys[index * 16:index * 16 + 16]) if flags & _HAS_MSG_KEY else None,
+        )
+
+    def __getitem__(self, index: int) -> MessageContainer:
+        flags = self._flags[index]
+        meta = self.meta(index)
+        if (obj := self._objects.get(index)) is not None:
+            return MessageContainer(meta=meta, obj=obj, raw_data_decrypted=True)
+
+        raw_data = bytes(self._bodies[self._offsets[index]:self._offsets[index + 1]])
+        if flags & _DECODE:
+            # Malformed body must not prevent saving other messages of connection, it is saved undecoded instead
+            try:
+                return MTProto.parse(meta, raw_data, True)
+            except Exception:
+                pass
+        return MessageContainer(meta=meta, obj=None, raw_data=raw_data, raw_data_decrypted=bool(flags & _DECRYPTED))
+
+    def __iter__(self) -> Iterator[MessageContainer]:
+        for index in range(len(self)):
+            yield self[index]
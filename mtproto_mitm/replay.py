@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import asyncio
+import resource
+import socket
+from collections import deque
+from multiprocessing import Process
+from pathlib import Path
+from time import perf_counter, process_time, sleep
+
+import click
+from mtproto import ConnectionRole
+from mtproto.enums import TransportType
+from mtproto.transport import Connection
+from socks5server import DataDirection
+
+from mtproto_mitm.capture import CaptureReader
+from mtproto_mitm.main import ConnectionPair, MitmServer, register_keys
+
+
+class ReplayChunk:
+    __slots__ = ("offset", "data", "after", "threshold",)
+
+    def __init__(self, offset: float, data: bytes, after: int, threshold: int | None):
+        # Seconds since start of session
+        self.offset = offset
+        self.data = data
+        # Progress of other side (packets received by server or bytes received by client) required before sending
+        self.after = after
+        # Progress of receiving side at which this chunk is fully received, None if it can't be known in advance
+        self.threshold = threshold
+
+
+class ReplaySession:
+    __slots__ = ("name", "to_server", "to_client",)
+
+    def __init__(self, name: str, to_server: list[ReplayChunk], to_client: list[ReplayChunk]):
+        self.name = name
+        self.to_server = to_server
+        self.to_client = to_client
+
+
+def load_session(path: Path) -> ReplaySession:
+    conn = ConnectionPair()
+    to_server: list[ReplayChunk] = []
+    to_client: list[ReplayChunk] = []
+    server_packets = 0
+    client_bytes = 0
+    start = None
+
+    with CaptureReader(path) as capture:
+        for record in capture:
+            if start is None:
+                start = record.timestamp
+
+            current, receiver = conn.for_direction(record.direction)
+            current.data_received(record.data)
+            sizes = []
+            while (packet := current.next_event()) is not None:
+                sizes.append(len(receiver.send(packet)))
+
+            offset = record.timestamp - start
+            if record.direction is DataDirection.CLIENT_TO_DST:
+                server_packets += len(sizes)
+                to_server.append(ReplayChunk(offset, record.data, client_bytes, server_packets))
+            else:
+                # Server receives packets unchanged, but client receives them re-encoded with its own transport
+                client_bytes += sum(sizes)
+                to_client.append(ReplayChunk(offset, record.data, server_packets, client_bytes))
+
+    # Padded intermediate transport adds random padding, so sizes of packets received by client are not known
+    if conn.to_server.transport_type is TransportType.PADDED_INTERMEDIATE:
+        for chunk in to_server:
+            chunk.after = 0
+        for chunk in to_client:
+            chunk.threshold = None
+
+    return ReplaySession(path.name, to_server, to_client)
+
+
+class _Progress:
+    __slots__ = ("value", "latencies", "_pending", "_changed",)
+
+    def __init__(self, latencies: list[float]):
+        self.value = 0
+        self.latencies = latencies
+        self._pending: deque[tuple[int, float]] = deque()
+        self._changed = asyncio.Event()
+
+    def sent(self, threshold: int | None) -> None:
+        if threshold is not None:
+            self._pending.append((threshold, perf_counter()))
+
+    def advance(self, amount: int) -> None:
+        self.value += amount
+        now = perf_counter()
+        while self._pending and self._pending[0][0] <= self.value:
+            self.latencies.append(now - self._pending.popleft()[1])
+        self._changed.set()
+
+    async def wait(self, value: int) -> None:
+        while self.value < value:
+            self._changed.clear()
+            await self._changed.wait()
+
+
+class ReplayStats:
+    def __init__(self):
+        self.sessions = 0
+        self.failed = 0
+        self.bytes = 0
+        self.to_server: list[float] = []
+        self.to_client: list[float] = []
+
+
+async def _send(
+        writer: asyncio.StreamWriter, chunks: list[ReplayChunk], start: float, speed: float, other: _Progress,
+        receiver: _Progress, stats: ReplayStats,
+) -> None:
+    loop = asyncio.get_running_loop()
+    for chunk in chunks:
+        if speed > 0 and (delay := start + chunk.offset / speed - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        await other.wait(chunk.after)
+
+        receiver.sent(chunk.threshold)
+        writer.write(chunk.data)
+        stats.bytes += len(chunk.data)
+        await writer.drain()
+
+
+async def _receive(reader: asyncio.StreamReader, progress: _Progress, parse: bool) -> None:
+    conn = Connection(ConnectionRole.SERVER)
+    while data := await reader.read(64 * 1024):
+        if not parse:
+            progress.advance(len(data))
+            continue
+
+        conn.data_received(data)
+        packets = 0
+        while conn.next_event() is not None:
+            packets += 1
+        progress.advance(packets)
+
+
+async def replay_session(
+        session: ReplaySession, proxy_port: int, speed: float, timeout: float, stats: ReplayStats,
+) -> None:
+    to_server = _Progress(stats.to_server)
+    to_client = _Progress(stats.to_client)
+    started = asyncio.get_running_loop().create_future()
+    tasks = []
+
+    async def _handle_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        tasks.append(asyncio.current_task())
+        try:
+            start = await started
+            tasks.append(asyncio.create_task(
+                _send(writer, session.to_client, start, speed, to_server, to_client, stats)
+            ))
+            await _receive(reader, to_server, True)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(_handle_server, "127.0.0.1", 0)
+    server_port = server.sockets[0].getsockname()[1]
+
+    writer = None
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        writer.write(b"\x05\x01\x00")
+        await writer.drain()
+        await reader.readexactly(2)
+        writer.write(b"\x05\x01\x00\x01" + socket.inet_aton("127.0.0.1") + server_port.to_bytes(2, "big"))
+        await writer.drain()
+        if (await reader.readexactly(10))[1] != 0:
+            raise ConnectionError("Proxy refused to connect")
+
+        started.set_result(asyncio.get_running_loop().time())
+        tasks.append(asyncio.create_task(_receive(reader, to_client, False)))
+        await _send(writer, session.to_server, started.result(), speed, to_client, to_server, stats)
+
+        last_server = session.to_server[-1].threshold if session.to_server else 0
+        last_client = session.to_client[-1].threshold if session.to_client else None
+        await asyncio.wait_for(to_server.wait(last_server), timeout)
+        if last_client is not None:
+            await asyncio.wait_for(to_client.wait(last_client), timeout)
+        stats.sessions += 1
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+        stats.failed += 1
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if writer is not None:
+            writer.close()
+        server.close()
+
+
+async def replay(
+        sessions: list[ReplaySession], concurrency: int, proxy_port: int, speed: float, timeout: float,
+) -> ReplayStats:
+    stats = ReplayStats()
+    await asyncio.gather(*(
+        replay_session(sessions[i % len(sessions)], proxy_port, speed, timeout, stats)
+        for i in range(concurrency)
+    ))
+    return stats
+
+
+def _run_proxy(port: int, key: list[str], keys_file: str | None) -> None:
+    # Forked process may inherit closed event loop of previous replay
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    register_keys(key, keys_file)
+    MitmServer("127.0.0.1", port, no_auth=True, quiet=True).run()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = perf_counter() + timeout
+    while True:
+        try:
+            # Unsupported socks version is rejected by proxy right away, without starting a session
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as sock:
+                sock.sendall(b"\x04")
+                sock.recv(2)
+            return
+        except ConnectionError:
+            if perf_counter() > deadline:
+                raise
+            sleep(0.05)
+
+
+def _children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _latencies(values: list[float]) -> str:
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    percentiles = [values[min(int(len(values) * q), len(values) - 1)] * 1000 for q in (0.5, 0.95, 0.99)]
+    return "/".join(f"{value:.2f}" for value in (*percentiles, values[-1] * 1000))
+
+
+@click.command()
+@click.argument("captures", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option("--concurrency", "-c", type=click.INT, multiple=True, default=[1],
+              help="Number of concurrently replayed sessions, may be given multiple times to compare.")
+@click.option("--speed", "-s", type=click.FLOAT, default=1.0,
+              help="Replay speed multiplier (0 to replay as fast as possible).")
+@click.option("--timeout", type=click.FLOAT, default=30.0,
+              help="Seconds to wait for remaining data after session is replayed.")
+@click.option("--key", "-k", type=click.STRING, multiple=True, help="Hex-encoded telegram auth key.")
+@click.option("--keys-file", "-f", type=click.STRING, default=None, help="File with telegram auth keys.")
+def main(captures: list[Path], concurrency: list[int], speed: float, timeout: float, key: list[str],
+         keys_file: str | None):
+    sessions = [load_session(path) for path in captures]
+    print(f"Loaded {len(sessions)} sessions")
+    print(
+        f"{'concurrency':>11} {'ok':>6} {'failed':>6} {'MiB':>8} {'wall, s':>8} {'proxy cpu, s':>12} {'cpu':>5} "
+        f"{'to server, ms (p50/p95/p99/max)':>32} {'to client, ms (p50/p95/p99/max)':>32}"
+    )
+
+    for level in concurrency:
+        port = _free_port()
+        proxy = Process(target=_run_proxy, args=(port, key, keys_file), daemon=True)
+        proxy.start()
+        _wait_for_port(port)
+
+        cpu_before = _children_cpu()
+        wall_start = perf_counter()
+        load_cpu_start = process_time()
+        stats = asyncio.run(replay(sessions, level, port, speed, timeout))
+        wall = perf_counter() - wall_start
+        load_cpu = process_time() - load_cpu_start
+
+        proxy.terminate()
+        proxy.join()
+        proxy_cpu = _children_cpu() - cpu_before
+
+        print(
+            f"{level:>11} {stats.sessions:>6} {stats.failed:>6} {stats.bytes / 1024 / 1024:>8.2f} {wall:>8.2f} "
+            f"{proxy_cpu:>12.2f} {proxy_cpu / wall:>5.0%} {_latencies(stats.to_server):>32} "
+            f"{_latencies(stats.to_client):>32}"
+        )
+        if load_cpu / wall > 0.9:
+            print(f"  Warning: load generator itself used {load_cpu / wall:.0%} cpu, results may be limited by it")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+from collections import deque
+from heapq import heappush, heappop
+from typing import Hashable, Iterator
+
+from mtproto_mitm.protocol import MessageContainer
+
+SessionKey = tuple[int, int]
+MessageKey = tuple[int, int]
+
+
+class _Stream:
+    __slots__ = ("pending", "last_key", "closed",)
+
+    def __init__(self):
+        self.pending: deque[MessageContainer] = deque()
+        self.last_key: MessageKey = (0, 0)
+        self.closed = False
+
+
+def _message_key(message: MessageContainer) -> MessageKey:
+    return message.meta.message_id, message.meta.seq_no or 0
+
+
+class SessionTimeline:
+    """
+    Merges messages of one (auth_key_id, session_id) pair coming from multiple streams (connection + direction).
+    Every stream is expected to be ordered by message_id, so only the head of each stream is kept in the heap and
+    messages are released as soon as no open stream can produce a message with a lower key.
+    """
+
+    __slots__ = ("auth_key_id", "session_id", "_streams", "_heap", "_counter",)
+
+    def __init__(self, auth_key_id: int, session_id: int):
+        self.auth_key_id = auth_key_id
+        self.session_id = session_id
+        self._streams: dict[Hashable, _Stream] = {}
+        self._heap: list[tuple[int, int, int, Hashable]] = []
+        self._counter = 0
+
+    def _push_head(self, stream_key: Hashable, stream: _Stream) -> None:
+        heappush(self._heap, (*_message_key(stream.pending[0]), self._counter, stream_key))
+        self._counter += 1
+
+    def push(self, stream_key: Hashable, message: MessageContainer) -> None:
+        if (stream := self._streams.get(stream_key)) is None:
+            stream = self._streams[stream_key] = _Stream()
+
+        stream.pending.append(message)
+        stream.last_key = max(stream.last_key, _message_key(message))
+        if len(stream.pending) == 1:
+            self._push_head(stream_key, stream)
+
+    def close(self, stream_key: Hashable) -> None:
+        if (stream := self._streams.get(stream_key)) is not None:
+            stream.closed = True
+
+    def _watermark(self) -> MessageKey | None:
+        open_keys = [stream.last_key for stream in self._streams.values() if not stream.closed]
+        return min(open_keys) if open_keys else None
+
+    def pop_ready(self) -> list[MessageContainer]:
+        watermark = self._watermark()
+        result = []
+
+        while self._heap and (watermark is None or self._heap[0][:2] <= watermark):
+            *_, stream_key = heappop(self._heap)
+            stream = self._streams[stream_key]
+            result.append(stream.pending.popleft())
+            if stream.pending:
+                self._push_head(stream_key, stream)
+
+        for stream_key, stream in list(self._streams.items()):
+            if stream.closed and not stream.pending:
+                del self._streams[stream_key]
+
+        return result
+
+    @property
+    def finished(self) -> bool:
+        return not self._streams
+
+
+class TimelineAggregator:
+    def __init__(self):
+        self._timelines: dict[SessionKey, SessionTimeline] = {}
+        self._stream_sessions: dict[Hashable, set[SessionKey]] = {}
+
+    def add(self, stream_key: Hashable, message: MessageContainer) -> None:
+        meta = message.meta
+        if meta.session_id is None or meta.message_id is None:
+            return
+
+        session_key = (meta.auth_key_id, meta.session_id)
+        if (timeline := self._timelines.get(session_key)) is None:
+            timeline = self._timelines[session_key] = SessionTimeline(*session_key)
+
+        timeline.push(stream_key, message)
+        self._stream_sessions.setdefault(stream_key, set()).add(session_key)
+
+    def close(self, stream_key: Hashable) -> None:
+        for session_key in self._stream_sessions.pop(stream_key, ()):
+            self._timelines[session_key].close(stream_key)
+
+    def close_all(self) -> None:
+        for stream_key in list(self._stream_sessions):
+            self.close(stream_key)
+
+    def drain(self) -> Iterator[tuple[SessionKey, list[MessageContainer]]]:
+        for session_key, timeline in list(self._timelines.items()):
+            if messages := timeline.pop_ready():
+                yield session_key, messages
+            if timeline.finished:
+                del self._timelines[session_key]
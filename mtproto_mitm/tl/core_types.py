@@ -1,7 +1,9 @@
 from __future__ import annotations
 
-from gzip import decompress
+from dataclasses import field as dc_field
 from io import BytesIO
+from typing import ClassVar
+from zlib import decompressobj, MAX_WBITS, error as ZlibError
 
 from mtproto_mitm import tl
 from mtproto_mitm.tl import TLField, TLObject, tl_object, SerializationUtils
@@ -76,13 +78,52 @@ class RpcResult(TLObject):
     result: TLObject = TLField()
 
 
+def _gzip_decompress(data: bytes, max_size: int) -> bytes:
+    decompressor = decompressobj(16 + MAX_WBITS)
+    try:
+        result = decompressor.decompress(data, max_size + 1)
+    except ZlibError as e:
+        raise RuntimeError(f"Invalid gzip data: {e}")
+
+    if len(result) > max_size:
+        raise RuntimeError(f"Gzip data is larger than {max_size} bytes")
+    if not decompressor.eof:
+        raise RuntimeError("Gzip data is truncated")
+
+    return result
+
+
 @tl_object(id=0x3072cfa1, name="GzipPacked")
 class GzipPacked(TLObject):
     packed_data: bytes = TLField()
+    _unpacked: TLObject | None = dc_field(default=None, init=False, repr=False, compare=False)
+
+    lazy: ClassVar[bool] = False
+    max_unpacked_size: ClassVar[int] = 16 * 1024 * 1024
 
     @classmethod
     def deserialize(cls, stream) -> TLObject:
-        packed_data = SerializationUtils.read(stream, bytes)
-        decompressed_stream = BytesIO(decompress(packed_data))
+        packed = GzipPacked(packed_data=SerializationUtils.read(stream, bytes))
+        if cls.lazy:
+            return packed
+
+        return packed.obj
+
+    @property
+    def unpacked(self) -> bool:
+        return self._unpacked is not None
+
+    @property
+    def obj(self) -> TLObject:
+        if self._unpacked is None:
+            decompressed_stream = BytesIO(_gzip_decompress(self.packed_data, self.max_unpacked_size))
+            self._unpacked = SerializationUtils.read(decompressed_stream, TLObject)
+
+        return self._unpacked
+
+    def to_dict(self) -> dict:
+        result = TLObject.to_dict(self)
+        if self._unpacked is not None:
+            result["obj"] = self._unpacked
 
-        return SerializationUtils.read(decompressed_stream, TLObject)
+        return result
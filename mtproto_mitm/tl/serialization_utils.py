@@ -11,6 +11,9 @@ VECTOR = b"\x15\xc4\xb5\x1c"
 
 
 class SerializationUtils:
+    # Optional object that deduplicates decoded strings and (sub)objects, see mtproto_mitm.cache.DecodeCache
+    interner = None
+
     @staticmethod
     def read(stream, type_: type[T], subtype: type=None) -> T:
         if issubclass(type_, tl.Int):
@@ -34,12 +37,19 @@ class SerializationUtils:
 
             return result
         elif issubclass(type_, str):
-            return SerializationUtils.read(stream, bytes).decode("utf8")
+            value = SerializationUtils.read(stream, bytes).decode("utf8")
+            if SerializationUtils.interner is not None:
+                return SerializationUtils.interner.intern_string(value)
+            return value
         elif issubclass(type_, (tl.TLObject, tl.TLObjectBase)):
+            start = stream.tell() if SerializationUtils.interner is not None else 0
             constructor = int.from_bytes(stream.read(4), "little")
             if constructor not in tl.all.objects:
                 raise RuntimeError(f"Unknown constructor: {constructor}")
-            return tl.all.objects[constructor].deserialize(stream)
+            obj = tl.all.objects[constructor].deserialize(stream)
+            if SerializationUtils.interner is not None:
+                return SerializationUtils.interner.intern_object(stream, start, obj)
+            return obj
         elif issubclass(type_, list):
             assert stream.read(4) == VECTOR
             count = SerializationUtils.read(stream, tl.Int)
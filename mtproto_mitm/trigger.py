@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import Hashable, Iterator, Any
+
+from mtproto_mitm.protocol import MessageContainer
+from mtproto_mitm.tl import TLObject, GzipPacked
+
+
+def _normalize(name: str) -> str:
+    return name.replace("_", "").lower()
+
+
+def _walk(obj: TLObject) -> Iterator[TLObject]:
+    stack: list[Any] = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, GzipPacked):
+            try:
+                stack.append(value.obj)
+            except RuntimeError:
+                pass
+        elif isinstance(value, TLObject):
+            yield value
+            stack.extend(getattr(value, field.name) for field in value.__tl_fields__)
+        elif isinstance(value, list):
+            stack.extend(value)
+
+
+class Trigger:
+    __slots__ = ("spec", "name", "field", "value",)
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        name, _, condition = spec.partition(":")
+        self.name = _normalize(name)
+        self.field, _, self.value = condition.partition("=")
+
+    def _matches_name(self, obj: TLObject) -> bool:
+        tlname = _normalize(obj.tlname())
+        return tlname == self.name or tlname.endswith(f".{self.name}")
+
+    def _matches_field(self, obj: TLObject) -> bool:
+        if not self.field:
+            return True
+        if not hasattr(obj, self.field):
+            return False
+        return str(getattr(obj, self.field)) == self.value
+
+    def matches(self, obj: TLObject) -> bool:
+        return any(self._matches_name(inner) and self._matches_field(inner) for inner in _walk(obj))
+
+
+class TriggerCapture:
+    def __init__(self, triggers: list[Trigger], buffer_size: int = 256, post_trigger: float = 10.0):
+        self._triggers = triggers
+        self._buffer_size = buffer_size
+        self._post_trigger = post_trigger
+        self._buffers: dict[Hashable, deque[tuple[Any, MessageContainer]]] = {}
+        self._recording_until: dict[Hashable, float] = {}
+
+    def match(self, message: MessageContainer) -> Trigger | None:
+        if message.obj is None:
+            return None
+        for trigger in self._triggers:
+            if trigger.matches(message.obj):
+                return trigger
+
+    def process(
+            self, key: Hashable, tag: Any, message: MessageContainer, received: float,
+    ) -> tuple[Trigger | None, list[tuple[Any, MessageContainer]]]:
+        # Post-trigger window is measured by time messages were received at (time.monotonic()),
+        #  not by time they are processed at, which may be much later
+        if (buffer := self._buffers.get(key)) is None:
+            buffer = self._buffers[key] = deque(maxlen=self._buffer_size)
+
+        if (trigger := self.match(message)) is not None:
+            result = [*buffer, (tag, message)]
+            buffer.clear()
+            self._recording_until[key] = received + self._post_trigger
+            return trigger, result
+
+        if self._recording_until.get(key, 0) >= received:
+            return None, [(tag, message)]
+
+        buffer.append((tag, message))
+        return None, []
+
+    def discard(self, key: Hashable) -> None:
+        self._buffers.pop(key, None)
+        self._recording_until.pop(key, None)